@@ -6,6 +6,11 @@ from scipy import integrate
 from scipy import interpolate
 from astropy.io import fits
 from glob import glob
+try:
+    import fitsio
+except ImportError:
+    # optional package, the images will be read with astropy
+    fitsio = None
 from copy import deepcopy
 import matplotlib
 # matplotlib.use("TkAgg")
@@ -46,6 +51,31 @@ def find_nearest(arr, value):
     return arr[idx], idx
 
 
+def read_image_extensions(fits_file, extnames, hdul=None):
+    """
+    This function reads the data of the given image extensions of a reference file, with fitsio if it is
+    installed and otherwise with astropy.
+    Args:
+        fits_file: string, path of the fits file
+        extnames: list, names of the image extensions to read
+        hdul: astropy HDUList of fits_file that is already open, used instead of opening the file again
+              when fitsio is not installed
+
+    Returns:
+        images: list, data arrays in the same order as extnames (raises KeyError if an extension does not exist)
+    """
+    if fitsio is not None:
+        with fitsio.FITS(fits_file) as ff:
+            for extname in extnames:
+                if extname not in ff:
+                    raise KeyError("Extension {} not found in {}".format(extname, fits_file))
+            return [ff[extname].read() for extname in extnames]
+    if hdul is not None:
+        return [hdul[extname].data for extname in extnames]
+    with fits.open(fits_file) as hdul:
+        return [hdul[extname].data for extname in extnames]
+
+
 def get_sci_extensions(fits_file_name, lists=True):
     """
     This functions obtains all the science extensions in the given file
@@ -112,6 +142,22 @@ def get_vminmax(img):
     return vminmax
 
 
+def get_diff_percent(mean_pipe, mean_calc):
+    """
+    This function calculates the percentage difference of the validation mean with respect to the pipeline mean.
+    Args:
+        mean_pipe: float, mean of the pipeline values
+        mean_calc: float, mean of the validation-calculated values
+
+    Returns:
+        diff_percent: integer, absolute percentage difference, 0 if it cannot be determined
+    """
+    rel_diff = 1.0 - mean_calc/mean_pipe
+    if np.isfinite(rel_diff):
+        return int(abs(rel_diff) * 100.0)
+    return 0
+
+
 def calc_flat_total_slt_err(flat_field_outfile, slt_nme, flout_slt_sci, flout_slt_err,
                             input_sci, input_err, input_var_psn, input_var_rnse,
                             pipeflat, pipeflat_err, calcflat, calcflat_err,
@@ -146,81 +192,77 @@ def calc_flat_total_slt_err(flat_field_outfile, slt_nme, flout_slt_sci, flout_sl
     print('\n Calculating total errors for slit ', slt_nme)
 
     # match nans for all arrays
-    nan_idx = (np.isnan(pipeflat) | np.isnan(calcflat)
-               | np.isnan(pipeflat_err) | np.isnan(calcflat_err))
-    pipeflat[nan_idx] = np.nan
-    calcflat[nan_idx] = np.nan
-    pipeflat_err[nan_idx] = np.nan
-    calcflat_err[nan_idx] = np.nan
-
-    # Calculate flat correction of SCI data and ignore all nan and inf values
+    nan_idx = np.isnan(pipeflat)
+    for arr in (calcflat, pipeflat_err, calcflat_err):
+        nan_idx |= np.isnan(arr)
+    for arr in (pipeflat, calcflat, pipeflat_err, calcflat_err):
+        np.copyto(arr, np.nan, where=nan_idx)
+
+    # Calculate flat correction of SCI data and ignore all nan and inf values, the statistics of the
+    # arrays with only the finite values do not need the nan-ignoring numpy functions
     pipe_corr_sci = input_sci / pipeflat
     pipe_corr = pipe_corr_sci[((np.isfinite(pipe_corr_sci)) & (pipe_corr_sci != 0.0))]
     calc_corr_sci = input_sci / calcflat
     calc_corr = calc_corr_sci[((np.isfinite(calc_corr_sci)) & (calc_corr_sci != 0.0))]
     diff_corr_sci = pipe_corr_sci - calc_corr_sci
-    diff_corr_sci_good_idx = np.where(diff_corr_sci <= 1.0)
-    mean_pipe, mean_calc = np.nanmean(pipe_corr), np.nanmean(calc_corr)
-    median_pipe, median_calc = np.nanmedian(pipe_corr), np.nanmedian(calc_corr)
-    diff_percent = '0%'
-    if np.isfinite(1.0 - mean_calc/mean_pipe):
-        diff_percent = repr(int(abs(1.0 - mean_calc/mean_pipe) * 100.0))+'%'
+    diff_corr_sci_good_idx = diff_corr_sci <= 1.0
+    mean_pipe, mean_calc = np.mean(pipe_corr), np.mean(calc_corr)
+    median_pipe, median_calc = np.median(pipe_corr), np.median(calc_corr)
+    diff_percent = repr(get_diff_percent(mean_pipe, mean_calc))+'%'
     print('\n * Mean difference of flat corrected SCI values: ',
           np.nanmean(diff_corr_sci[diff_corr_sci_good_idx]), ' -> ', diff_percent)
     print('       mean_pipe, mean_calc = ', mean_pipe, mean_calc)
     print('       median_pipe, median_calc = ', median_pipe, median_calc)
     print('       final pipeline calculated SCI mean = ', np.nanmean(flout_slt_sci))
 
+    # squares used for the variance corrections
+    pipeflat_sq, calcflat_sq, input_sci_sq = np.square(pipeflat), np.square(calcflat), np.square(input_sci)
+
     # Calculate flat correction of VAR_POISSON data and ignore all nan and inf values
-    pipe_corr_var_poisson_sci = input_var_psn / pipeflat**2
+    pipe_corr_var_poisson_sci = input_var_psn / pipeflat_sq
     pipe_corr_vpsn = pipe_corr_var_poisson_sci[((np.isfinite(pipe_corr_var_poisson_sci)) & (pipe_corr_var_poisson_sci != 0.0))]
-    calc_corr_var_poisson_sci = input_var_psn / calcflat**2
+    calc_corr_var_poisson_sci = input_var_psn / calcflat_sq
     calc_corr_vpsn = calc_corr_var_poisson_sci[((np.isfinite(calc_corr_var_poisson_sci)) & (calc_corr_var_poisson_sci != 0.0))]
     diff_var_poisson_sci = pipe_corr_var_poisson_sci - calc_corr_var_poisson_sci
-    diff_var_poisson_sci_good_idx = np.where(diff_var_poisson_sci <= 1.0)
-    mean_pipe, mean_calc = np.nanmean(pipe_corr_vpsn), np.nanmean(calc_corr_vpsn)
-    median_pipe, median_calc = np.nanmedian(pipe_corr_vpsn), np.nanmedian(calc_corr_vpsn)
-    diff_percent = '0%'
-    if np.isfinite(1.0 - mean_calc/mean_pipe):
-        diff_percent = repr(int(abs(1.0 - mean_calc/mean_pipe) * 100.0))+'%'
+    diff_var_poisson_sci_good_idx = diff_var_poisson_sci <= 1.0
+    mean_pipe, mean_calc = np.mean(pipe_corr_vpsn), np.mean(calc_corr_vpsn)
+    median_pipe, median_calc = np.median(pipe_corr_vpsn), np.median(calc_corr_vpsn)
+    diff_percent = repr(get_diff_percent(mean_pipe, mean_calc))+'%'
     print('\n * Mean difference of flat corrected VAR_POISSON values: ',
           np.nanmean(diff_var_poisson_sci[diff_var_poisson_sci_good_idx]),  ' -> ', diff_percent)
     print('       mean_pipe, mean_calc = ', mean_pipe, mean_calc)
     print('       median_pipe, median_calc = ', median_pipe, median_calc)
 
     # Calculate flat correction of VAR_RNOISE data and ignore all nan and inf values
-    pipe_corr_var_rnoise_sci = input_var_rnse / pipeflat**2
+    pipe_corr_var_rnoise_sci = input_var_rnse / pipeflat_sq
     pipe_corr_vrnse = pipe_corr_var_rnoise_sci[((np.isfinite(pipe_corr_var_rnoise_sci)) & (pipe_corr_var_rnoise_sci != 0.0))]
-    calc_corr_var_rnoise_sci = input_var_rnse / calcflat**2
+    calc_corr_var_rnoise_sci = input_var_rnse / calcflat_sq
     calc_corr_vrnse = calc_corr_var_rnoise_sci[((np.isfinite(calc_corr_var_rnoise_sci)) & (calc_corr_var_rnoise_sci != 0.0))]
     diff_var_rnoise_sci = pipe_corr_var_rnoise_sci - calc_corr_var_rnoise_sci
-    diff_var_rnoise_sci_good_idx = np.where(diff_var_rnoise_sci <= 1.0)
-    mean_pipe, mean_calc = np.nanmean(pipe_corr_vrnse), np.nanmean(calc_corr_vrnse)
-    median_pipe, median_calc = np.nanmedian(pipe_corr_vrnse), np.nanmedian(calc_corr_vrnse)
-    diff_percent = '0%'
-    if np.isfinite(1.0 - mean_calc/mean_pipe):
-        diff_percent = repr(int(abs(1.0 - mean_calc/mean_pipe) * 100.0))+'%'
+    diff_var_rnoise_sci_good_idx = diff_var_rnoise_sci <= 1.0
+    mean_pipe, mean_calc = np.mean(pipe_corr_vrnse), np.mean(calc_corr_vrnse)
+    median_pipe, median_calc = np.median(pipe_corr_vrnse), np.median(calc_corr_vrnse)
+    diff_percent = repr(get_diff_percent(mean_pipe, mean_calc))+'%'
     print('\n * Mean difference of flat corrected VAR_RNOISE values: ',
           np.nanmean(diff_var_rnoise_sci[diff_var_rnoise_sci_good_idx]),  ' -> ', diff_percent)
     print('       mean_pipe, mean_calc = ', mean_pipe, mean_calc)
     print('       median_pipe, median_calc = ', median_pipe, median_calc)
 
     # Calculate flat correction of VAR_FLAT data and data and ignore all nan and inf values
-    pipe_corr_var_flat_sci = input_sci**2 * pipeflat_err**2 / pipeflat**4
+    pipeflat_err_sq, calcflat_err_sq = np.square(pipeflat_err), np.square(calcflat_err)
+    pipe_corr_var_flat_sci = input_sci_sq * pipeflat_err_sq / pipeflat**4
     pipe_corr_vflat = pipe_corr_var_flat_sci[((np.isfinite(pipe_corr_var_flat_sci)) & (pipe_corr_var_flat_sci != 0.0))]
 
-    calc_corr_var_flat_sci = input_sci**2 * calcflat_err**2 / calcflat**4
+    calc_corr_var_flat_sci = input_sci_sq * calcflat_err_sq / calcflat**4
     calc_corr_vflat = calc_corr_var_flat_sci[((np.isfinite(calc_corr_var_flat_sci)) & (calc_corr_var_flat_sci != 0.0))]
 
     diff_var_flat_sci = pipe_corr_var_flat_sci - calc_corr_var_flat_sci
     diff_var_flat_sci = diff_var_flat_sci[(np.isfinite(diff_var_flat_sci) & (diff_var_flat_sci <= 1.0))]
-    mean_pipe, mean_calc = np.nanmean(pipe_corr_vflat), np.nanmean(calc_corr_vflat)
-    median_pipe, median_calc = np.nanmedian(pipe_corr_vflat), np.nanmedian(calc_corr_vflat)
-    diff_percent = 0
-    if np.isfinite(1.0 - mean_calc/mean_pipe):
-        diff_percent = int(abs(1.0 - mean_calc/mean_pipe) * 100.0)
+    mean_pipe, mean_calc = np.mean(pipe_corr_vflat), np.mean(calc_corr_vflat)
+    median_pipe, median_calc = np.median(pipe_corr_vflat), np.median(calc_corr_vflat)
+    diff_percent = get_diff_percent(mean_pipe, mean_calc)
     print('\n * Mean difference of flat corrected VAR_FLAT values: ',
-          np.nanmean(diff_var_flat_sci), ' -> ', repr(diff_percent)+'%')
+          np.mean(diff_var_flat_sci), ' -> ', repr(diff_percent)+'%')
     print('       mean_pipe, mean_calc = ', mean_pipe, mean_calc)
     print('       median_pipe, median_calc = ', median_pipe, median_calc)
 
@@ -235,33 +277,36 @@ def calc_flat_total_slt_err(flat_field_outfile, slt_nme, flout_slt_sci, flout_sl
     elif diff_percent >= 50:
         print('   Maybe an issue of outliers, check median values and other stats: ')
         print('       np.nanmean(input_sci**2/pipeflat**2), np.nanmean(input_sci**2/calcflat**2)')
-        kk1 = input_sci**2/pipeflat**2
+        kk1 = input_sci_sq/pipeflat_sq
         kk1 = kk1[~np.isnan(kk1)]
-        kk2 = input_sci**2/calcflat**2
+        kk2 = input_sci_sq/calcflat_sq
         kk2 = kk2[~np.isnan(kk2)]
         print('       ', np.nanmean(kk1), np.nanmean(kk2))
         print('       np.nanmedian(input_sci**2/pipeflat**2), np.nanmedian(input_sci**2/calcflat**2)')
         print('       ', np.nanmedian(kk1), np.nanmedian(kk2))
         print('     Means and medians where arrays are not 0.0: ')
         print('       np.nanmean(pipeflat_err**2), np.nanmean(calcflat_err**2), difference')
-        kk1 = pipeflat_err[pipeflat_err!=0.0]**2
+        kk1 = pipeflat_err_sq[pipeflat_err!=0.0]
         kk1 = kk1[~np.isnan(kk1)]
-        kk2 = calcflat_err[calcflat_err!=0.0]**2
+        kk2 = calcflat_err_sq[calcflat_err!=0.0]
         kk2 = kk2[~np.isnan(kk2)]
         print('       ', np.nanmean(kk1), np.nanmean(kk2), np.nanmean(kk1)-np.nanmean(kk2))
         print('       np.nanmedian(pipeflat_err**2), np.nanmedian(calcflat_err**2), difference')
         print('       ', np.nanmedian(kk1), np.nanmedian(kk2), np.nanmedian(kk1)-np.nanmedian(kk2))
 
     # Total error calculation
-    pipe_err_sci = np.sqrt(pipe_corr_var_poisson_sci + pipe_corr_var_rnoise_sci + pipe_corr_var_flat_sci)
-    calc_err_sci = np.sqrt(calc_corr_var_poisson_sci + calc_corr_var_rnoise_sci + calc_corr_var_flat_sci)
+    # accumulate in place to avoid full frame temporaries
+    pipe_err_sci = pipe_corr_var_poisson_sci + pipe_corr_var_rnoise_sci
+    pipe_err_sci += pipe_corr_var_flat_sci
+    np.sqrt(pipe_err_sci, out=pipe_err_sci)
+    calc_err_sci = calc_corr_var_poisson_sci + calc_corr_var_rnoise_sci
+    calc_err_sci += calc_corr_var_flat_sci
+    np.sqrt(calc_err_sci, out=calc_err_sci)
     diff_tot_err = pipe_err_sci - calc_err_sci
-    diff_tot_err_good_idx = np.where(diff_tot_err <= 1.0)
+    diff_tot_err_good_idx = diff_tot_err <= 1.0
     mean_pipe, mean_calc = np.nanmean(pipe_err_sci), np.nanmean(calc_err_sci)
     median_pipe, median_calc = np.nanmedian(pipe_err_sci), np.nanmedian(calc_err_sci)
-    diff_percent = 0
-    if np.isfinite(1.0 - mean_calc/mean_pipe):
-        diff_percent = int(abs(1.0 - mean_calc/mean_pipe) * 100.0)
+    diff_percent = get_diff_percent(mean_pipe, mean_calc)
     print('\n * Mean difference of total error calculation: ',
           np.nanmean(diff_tot_err[diff_tot_err_good_idx]),  ' -> ', repr(diff_percent)+'%')
     print('       median_pipe, median_calc = ', median_pipe, median_calc)
@@ -1157,17 +1202,22 @@ def plt_two_2Dimgandhist(img, hist_data, info_img, info_hist, plt_name=None, plt
     str_x_stddev = "stddev = {:0.3e}".format(x_stddev)
     axs[1].set(xlabel=label_x, ylabel=label_y)
     axs[1].text(0.73, 0.67, str_x_stddev, transform=axs[1].transAxes, fontsize=fontsize)
+    counts = None
     if bins is None:
         try:
             xmin = x_median - x_stddev * 5
             xmax = x_median + x_stddev * 5
             binwidth = (xmax - xmin) / 40.
             bins = np.arange(xmin, xmax + binwidth, binwidth)
+            # the bins have equal width, so count them with the numpy uniform binning
+            counts, bins = np.histogram(hist_data, bins=bins.size-1, range=(bins[0], bins[-1]))
         except:
             ValueError
             bins = 15
-    n, bins, patches = axs[1].hist(hist_data, bins=bins, histtype='bar', ec='k',
-                                      facecolor="red", alpha=alpha)
+    if counts is not None:
+        axs[1].bar(bins[:-1], counts, width=np.diff(bins), align='edge', ec='k', facecolor="red", alpha=alpha)
+    else:
+        n, bins, patches = axs[1].hist(hist_data, bins=bins, histtype='bar', ec='k', facecolor="red", alpha=alpha)
     axs[1].xaxis.set_major_locator(MaxNLocator(8))
     majorFormatter = FuncFormatter(MyFormatter)
     axs[1].xaxis.set_major_formatter(majorFormatter)
@@ -159,10 +159,9 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
     log_msgs.append(msg1)
     with fits.open(dfile) as dfile_hdu:
         dfim = dfile_hdu["SCI"].data
-        dfimdq = dfile_hdu["DQ"].data
-        dfimerr = dfile_hdu["ERR"].data
         dfrqe = dfile_hdu["FAST_VARIATION"].data
         dfhdr_sci = dfile_hdu["SCI"].header
+        dfimdq, dfimerr = auxfunc.read_image_extensions(dfile, ("DQ", "ERR"), hdul=dfile_hdu)
         if debug:
             dfile_hdu.info()
     ns = np.shape(dfim)
@@ -171,11 +170,7 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
         print('D-flat: np.shape(SCI_array) =', np.shape(dfim))
         print('        np.shape(DQ_array) =', np.shape(dfimdq))
     # get the wavelength values from SCI header keywords
-    dfwave = np.array([])
-    for i in range(naxis3):
-        t = ("PFLAT", str(i + 1))
-        keyword = "_".join(t)
-        dfwave = np.append(dfwave, fits.getval(dfile, keyword, 1))
+    dfwave = np.fromiter((dfhdr_sci["PFLAT_"+str(i+1)] for i in range(naxis3)), dtype=float, count=naxis3)
 
     # S-flat
     mode = "FS"
@@ -210,9 +205,7 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
     print(msg)
     log_msgs.append(msg)
     with fits.open(sfile) as sfile_hdu:
-        sfim = sfile_hdu["SCI"].data
-        sfimdq = sfile_hdu["DQ"].data
-        sfimerr = sfile_hdu["ERR"].data
+        sfim, sfimdq, sfimerr = auxfunc.read_image_extensions(sfile, ("SCI", "DQ", "ERR"), hdul=sfile_hdu)
         sffastvar = sfile_hdu["FAST_VARIATION"].data
         if debug:
             print(sfile_hdu.info())
@@ -233,7 +226,7 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
     with fits.open(ffile) as ffile_hdu:
         fffastvar = ffile_hdu["FAST_VARIATION"].data
         try:
-            fferr = ffile_hdu["ERR"].data
+            fferr = auxfunc.read_image_extensions(ffile, ("ERR",), hdul=ffile_hdu)[0]
         except KeyError:   # this version of the file did not have ERR extension
             fferr = np.zeros((2048, 2048))
         if debug:
@@ -682,7 +675,7 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
 
                 # the file is not yet written, indicate that this slit was appended to list to be written
                 msg = "Extension " + repr(
-                    i) + " appended to list to be written into calculated and comparison fits files."
+                    si) + " appended to list to be written into calculated and comparison fits files."
                 print(msg)
                 log_msgs.append(msg)
 
@@ -705,10 +698,10 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
         complfile_name = flat_field_pipe_outfile.replace("flat_field", "flat_comp")
 
         # create the fits list to hold the calculated flat values for each slit
-        outfile.writeto(outfile_name, overwrite=True)
+        outfile.writeto(outfile_name, overwrite=True, output_verify="ignore")
 
         # this is the file to hold the image of pipeline-calculated difference values
-        complfile.writeto(complfile_name, overwrite=True)
+        complfile.writeto(complfile_name, overwrite=True, output_verify="ignore")
 
         print('')
         msg = "Fits file with calculated flat values of each slit saved as: "
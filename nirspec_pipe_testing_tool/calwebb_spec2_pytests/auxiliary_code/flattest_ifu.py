@@ -8,7 +8,6 @@ import matplotlib
 import matplotlib.pyplot as plt
 from astropy.io import fits
 from glob import glob
-from copy import deepcopy
 
 from gwcs import wcstools
 from gwcs.utils import _toindex
@@ -48,12 +47,15 @@ __version__ = "2.10"
 #                          be ok for flat correction calculation
 
 
+# font of the histogram plots, other modules change the matplotlib font so it is set for each plot
+hist_font = {#'family' : 'normal',
+             'weight' : 'normal',
+             'size'   : 16}
+
+
 def mk_hist(title, delfg, delfg_mean, delfg_median, delfg_std, save_figs, show_figs, plot_name):
     # create histogram
-    font = {#'family' : 'normal',
-            'weight' : 'normal',
-            'size'   : 16}
-    matplotlib.rc('font', **font)
+    matplotlib.rc('font', **hist_font)
     alpha = 0.2
     fontsize = 15
     fig = plt.figure(1, figsize=(12, 10))
@@ -65,8 +67,9 @@ def mk_hist(title, delfg, delfg_mean, delfg_median, delfg_std, save_figs, show_f
     else:
         plt.xlabel("flat$_{pipe}$ - flat$_{calc}$")
     plt.ylabel("N")
-    xmin = min(delfg) - (max(delfg) - min(delfg))*0.1
-    xmax = max(delfg) + (max(delfg) - min(delfg))*0.1
+    delfg_min, delfg_max = np.nanmin(delfg), np.nanmax(delfg)
+    xmin = delfg_min - (delfg_max - delfg_min)*0.1
+    xmax = delfg_max + (delfg_max - delfg_min)*0.1
     plt.xlim(xmin, xmax)
     if "all_slices" in title:
         #x_median = r"$\mu$(medians) = {:0.5}".format(delfg_median)
@@ -82,12 +85,12 @@ def mk_hist(title, delfg, delfg_mean, delfg_median, delfg_std, save_figs, show_f
     ax.text(0.74, 0.86, x_stddev, transform=ax.transAxes, fontsize=fontsize)
     plt.tick_params(axis='both', which='both', bottom=True, top=True, right=True, direction='in', labelbottom=True)
     binwidth = (xmax-xmin)/40.
-    _, _, _ = ax.hist(delfg, bins=np.arange(xmin, xmax + binwidth, binwidth), histtype='bar', ec='k', facecolor="red", alpha=alpha)
+    bins = np.arange(xmin, xmax + binwidth, binwidth)
+    _, _, _ = ax.hist(delfg, bins=bins, histtype='bar', ec='k', facecolor="red", alpha=alpha)
 
     if save_figs:
         if plot_name is None:
-            t = (title, ".png")
-            plot_name = "".join(t)
+            plot_name = f"{title}.png"
         plt.savefig(plot_name)
         print('\n Plot saved: ', plot_name)
     if show_figs:
@@ -95,9 +98,157 @@ def mk_hist(title, delfg, delfg_mean, delfg_median, delfg_std, save_figs, show_f
     plt.close()
 
 
+def get_pixel_bandwidth(flat_wave, nx):
+    """
+    This function calculates the wavelength bandwidth of each pixel of the flattened slice from the wavelengths of
+    its neighbors in the same row.
+    Args:
+        flat_wave: array, flattened wavelength array of the slice
+        nx: integer, number of pixels per row
+
+    Returns:
+        delw: array, bandwidth of each pixel
+    """
+    nw = flat_wave.size
+    col = np.arange(nw) % nx
+    next_wave, prev_wave = np.roll(flat_wave, -1), np.roll(flat_wave, 1)
+    delw = np.full(nw, 0.1)
+    # centered difference if both neighbors are valid, else use the valid side
+    centered = (col != 0) & (col != nx-1) & np.isfinite(next_wave) & np.isfinite(prev_wave)
+    delw[centered] = 0.5 * (next_wave[centered] - prev_wave[centered])
+    forward = (col == 0) | ~np.isfinite(prev_wave)
+    delw[forward] = 0.5 * (next_wave[forward] - flat_wave[forward])
+    backward = (col == nx-1) | ~np.isfinite(next_wave)
+    delw[backward] = 0.5 * (flat_wave[backward] - prev_wave[backward])
+    return delw
+
+
+def get_chunk_integrals(fv_wav, fv_dat, p=5):
+    """
+    This function calculates the lookup table to integrate the fast vector over any range of its points with
+    auxfunc.idl_tabulate, which adds the Newton-Cotes integrals of the chunks of p points starting at the first
+    point of the range and every p-1 points after it.
+    Args:
+        fv_wav: array, increasing wavelengths of the fast vector
+        fv_dat: array, data of the fast vector
+        p: integer, integrator order used by auxfunc.idl_tabulate
+
+    Returns:
+        chunk_integrals: array, integral of the chunk of p points starting at each point
+    """
+    chunk_integrals = np.zeros(max(fv_wav.size - p + 1, 0))
+    for i in range(chunk_integrals.size):
+        chunk_integrals[i] = auxfunc.idl_tabulate(fv_wav[i:i+p], fv_dat[i:i+p], p)
+    return chunk_integrals
+
+
+def get_fast_vector_values(jwav, wav_lo, wav_hi, ref_wav, ref_dat, tab_cache, debug=False):
+    """
+    This function obtains the fast vector values for the given pixel wavelengths. If more than 2 points of the
+    fast vector fall within the pixel bandwidth the vector is integrated over it, else it is interpolated.
+    Args:
+        jwav: array, wavelength of each pixel
+        wav_lo: array, lower limit of the bandwidth of each pixel
+        wav_hi: array, upper limit of the bandwidth of each pixel
+        ref_wav: array, wavelengths of the fast vector
+        ref_dat: array, data of the fast vector
+        tab_cache: dictionary, integration lookup table and integrals already calculated for this fast vector
+        debug: boolean
+
+    Returns:
+        fv_values: array, fast vector value for each pixel
+    """
+    fv_values = np.empty(jwav.size)
+    finite_wav = np.isfinite(ref_wav)
+    fv_wav, fv_dat = ref_wav[finite_wav], ref_dat[finite_wav]
+    fv_wav64 = fv_wav.astype(float)
+    increasing = fv_wav.size > 1 and np.all(fv_wav64[1:] > fv_wav64[:-1])
+    sorted_idx = np.argsort(fv_wav, kind='stable')
+    sorted_wav = fv_wav64[sorted_idx]
+
+    # integrate over the fast vector points within the bandwidth
+    first = np.searchsorted(sorted_wav, wav_lo, side='left')
+    last = np.searchsorted(sorted_wav, wav_hi, side='right')
+    tab_pts = np.flatnonzero(last - first > 2)
+    if increasing and "chunk_integrals" not in tab_cache:
+        tab_cache["chunk_integrals"] = get_chunk_integrals(fv_wav, fv_dat)
+    pt_ranges, range_idx = np.unique(np.stack((first[tab_pts], last[tab_pts])), axis=1, return_inverse=True)
+    range_values = np.empty(pt_ranges.shape[1])
+    for i, (first_pt, last_pt) in enumerate(pt_ranges.T):
+        if (first_pt, last_pt) not in tab_cache:
+            if increasing:
+                # add the full chunks from the lookup table in the same order as auxfunc.idl_tabulate
+                last_chunk = first_pt + 4 * ((last_pt - first_pt - 5) // 4 + 1)
+                int_tab = 0
+                for chunk_int in tab_cache["chunk_integrals"][first_pt:last_chunk:4]:
+                    int_tab += chunk_int
+                int_tab += auxfunc.idl_tabulate(fv_wav[last_chunk:last_pt], fv_dat[last_chunk:last_pt])
+                tab_cache[(first_pt, last_pt)] = int_tab/(fv_wav[last_pt-1] - fv_wav[first_pt])
+            else:
+                iw = np.sort(sorted_idx[first_pt:last_pt])
+                int_tab = auxfunc.idl_tabulate(fv_wav[iw], fv_dat[iw])
+                tab_cache[(first_pt, last_pt)] = int_tab/(fv_wav[iw][-1] - fv_wav[iw][0])
+        range_values[i] = tab_cache[(first_pt, last_pt)]
+    fv_values[tab_pts] = range_values[range_idx.ravel()]
+
+    # interpolate close to the pixel wavelength otherwise
+    interp_pts = np.flatnonzero(last - first <= 2)
+    if increasing:
+        # this reproduces auxfunc.interp_close_pts for increasing wavelengths, since the linear interpolation
+        # between the neighbors of the nearest point is the one of the entire array
+        iwav = jwav[interp_pts]
+        k = np.clip(np.searchsorted(fv_wav64, iwav), 1, fv_wav.size-1)
+        nearest = np.where(np.abs(fv_wav64[k-1] - iwav) <= np.abs(fv_wav64[k] - iwav), k-1, k)
+        ivalues = np.interp(iwav, fv_wav64, fv_dat)
+        exact = fv_wav64[nearest] == iwav
+        ivalues[exact] = fv_dat[nearest[exact]]
+        # below the first point interp_close_pts uses the points at both ends of the arrays
+        for i in np.flatnonzero((nearest == 0) & ~exact):
+            ivalues[i] = auxfunc.interp_close_pts(iwav[i], ref_wav, ref_dat, debug)
+        fv_values[interp_pts] = ivalues
+    else:
+        for i in interp_pts:
+            fv_values[i] = auxfunc.interp_close_pts(jwav[i], ref_wav, ref_dat, debug)
+    return fv_values
+
+
+def interp_cube_spectra(wav, cube_wav, spectra):
+    """
+    This function linearly interpolates the spectrum of each pixel of a flat cube at the pixel wavelength, giving
+    the same values as calling np.interp for each pixel.
+    Args:
+        wav: array, wavelength of each pixel
+        cube_wav: array, increasing wavelengths of the cube planes
+        spectra: 2D array, spectrum of each pixel along the first axis
+
+    Returns:
+        values: array, interpolated value for each pixel
+    """
+    spectra = spectra.astype(float)
+    pix = np.arange(wav.size)
+    j = np.clip(np.searchsorted(cube_wav, wav, side='right') - 1, 0, max(cube_wav.size - 2, 0))
+    j1 = np.minimum(j + 1, cube_wav.size - 1)
+    val0, val1 = spectra[j, pix], spectra[j1, pix]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (val1 - val0)/(cube_wav[j1] - cube_wav[j])
+        values = slope*(wav - cube_wav[j]) + val0
+        # same fallbacks as np.interp when the interpolation is not finite
+        redo = np.isnan(values)
+        values[redo] = slope[redo]*(wav[redo] - cube_wav[j1][redo]) + val1[redo]
+        redo &= np.isnan(values) & (val0 == val1)
+        values[redo] = val0[redo]
+    exact = wav == cube_wav[j]
+    values[exact] = val0[exact]
+    values[wav < cube_wav[0]] = spectra[0, wav < cube_wav[0]]
+    values[wav >= cube_wav[-1]] = spectra[-1, wav >= cube_wav[-1]]
+    if cube_wav.size > 1:
+        values[np.isnan(wav)] = np.nan
+    return values
+
+
 def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=False,
              mk_all_slices_plt=False, show_figs=True, save_figs=False, interpolated_flat=None,
-             threshold_diff=1.0e-7, debug=False):
+             threshold_diff=1.0e-7, debug=False, calc_total_err=True):
     """
     This function calculates the difference between the pipeline and the calculated flat field values.
     The functions uses the output of the compute_world_coordinates.py script.
@@ -113,6 +264,8 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
         save_figs: boolean, save the plots (the 3 plots can be saved or not independently with the function call)
         interpolated_flat: string, name of the on-the-fly interpolated pipeline flat
         debug: boolean, if true a series of print statements will show on-screen
+        calc_total_err: boolean, if False skip the comparison of the total errors after the flat field step, which
+                        only prints statistics and makes plots and does not change the test result
 
     Returns:
         - 1 plot, if told to save and/or show.
@@ -123,15 +276,18 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
 
     log_msgs = []
 
+    def _log(msg):
+        # print the message and keep it for the log file
+        print(msg)
+        log_msgs.append(msg)
+
     # start the timer
     flattest_start_time = time.time()
 
     # define the name of the needed files, if interpolated_flat is None then the input file name
     # is a string for the path and name of the flat field step output fits file
     if interpolated_flat is None:
-        msg = 'test_input_filename=' + step_input_filename
-        print(msg)
-        log_msgs.append(msg)
+        _log(f'test_input_filename={step_input_filename}')
         # copy the file to avoid corruption
         pipe_flat_file = step_input_filename.replace(".fits", "_copy.fits")
         shutil.copyfile(step_input_filename, pipe_flat_file)
@@ -174,28 +330,15 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
     lamp = model.meta.instrument.lamp_state
     exptype = model.meta.exposure.type.upper()
 
-    msg = "flat_field_file  -->     Grating:" + grat + "   Filter:" + filt + "   LAMP:" + lamp
-    print(msg)
-    log_msgs.append(msg)
-
-    msg0 = " * FOR COMPARISON, these are the reference files used by the pipeline"
-    msg1 = "    DATE-OBS = " + pipe_flat_field_mdl.meta.observation.date
-    msg2 = "    Pipeline CRDS context: " + pipe_flat_field_mdl.meta.ref_file.crds.context_used
-    msg3 = "    Pipeline ref d-flat used:  " + pipe_flat_field_mdl.meta.ref_file.dflat.name
-    msg4 = "    Pipeline ref s-flat used:  " + pipe_flat_field_mdl.meta.ref_file.sflat.name
-    msg5 = "    Pipeline ref f-flat used:  " + pipe_flat_field_mdl.meta.ref_file.fflat.name
-    print(msg0)
-    print(msg1)
-    print(msg2)
-    print(msg3)
-    print(msg4)
-    print(msg5)
-    log_msgs.append(msg0)
-    log_msgs.append(msg1)
-    log_msgs.append(msg2)
-    log_msgs.append(msg3)
-    log_msgs.append(msg4)
-    log_msgs.append(msg5)
+    _log(f"flat_field_file  -->     Grating:{grat}   Filter:{filt}   LAMP:{lamp}")
+
+    ref_file = pipe_flat_field_mdl.meta.ref_file
+    _log(" * FOR COMPARISON, these are the reference files used by the pipeline")
+    _log(f"    DATE-OBS = {pipe_flat_field_mdl.meta.observation.date}")
+    _log(f"    Pipeline CRDS context: {ref_file.crds.context_used}")
+    _log(f"    Pipeline ref d-flat used:  {ref_file.dflat.name}")
+    _log(f"    Pipeline ref s-flat used:  {ref_file.sflat.name}")
+    _log(f"    Pipeline ref f-flat used:  {ref_file.fflat.name}")
 
     # define the mode
     if "ifu" in exptype.lower():
@@ -204,38 +347,31 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
         mode = "not IFU data"
 
     # get the reference files
-    msg = "Getting and reading the D-, S-, and F-flats for this specific IFU configuration... "
-    print(msg)
-    log_msgs.append(msg)
+    _log("Getting and reading the D-, S-, and F-flats for this specific IFU configuration... ")
 
     # D-Flat
     if not os.path.isfile(dflat_path):
-        result_msg = "Test skipped because the D-flat provided does not exist: {}".format(dflat_path)
-        print(msg)
-        log_msgs.append(msg)
+        result_msg = f"Test skipped because the D-flat provided does not exist: {dflat_path}"
+        _log(result_msg)
         median_diff = "skip"
         return median_diff, result_msg, log_msgs
     dfile = dflat_path
-    msg0 = " * This flat test is using the following reference files "
-    msg1 = "    D-flat: " + dfile
-    print(msg0)
-    print(msg1)
-    log_msgs.append(msg0)
-    log_msgs.append(msg1)
-    with fits.open(dfile) as dfile_hdu:
+    _log(" * This flat test is using the following reference files ")
+    _log(f"    D-flat: {dfile}")
+    # the D-flat cube is memory-mapped, only the pixels of each slice are read from it
+    with fits.open(dfile, memmap=True) as dfile_hdu:
         dfim = dfile_hdu["SCI"].data
-        dfimdq = dfile_hdu["DQ"].data
-        dfimerr = dfile_hdu["ERR"].data
         dfrqe = dfile_hdu["FAST_VARIATION"].data
         dfile_scihdr = dfile_hdu["SCI"].header
+        dfimdq, dfimerr = auxfunc.read_image_extensions(dfile, ("DQ", "ERR"), hdul=dfile_hdu)
+    # the D-flat fast vector is the same for all the slices
+    dfrqe_wav = np.ascontiguousarray(dfrqe["wavelength"][0])
+    dfrqe_rqe = np.ascontiguousarray(dfrqe["data"][0])
     ns = np.shape(dfim)
     naxis3 = dfile_scihdr["NAXIS3"]
 
     # get the wavelength values
-    dfwave = np.array([])
-    for i in range(naxis3):
-        keyword = "PFLAT_"+str(i+1)
-        dfwave = np.append(dfwave, dfile_scihdr[keyword])
+    dfwave = np.fromiter((dfile_scihdr["PFLAT_"+str(i+1)] for i in range(naxis3)), dtype=float, count=naxis3)
 
     # S-flat
     if filt == "F070LP":
@@ -249,47 +385,36 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
     elif filt == "CLEAR":
         flat = "FLAT5"
     else:
-        msg = "No filter correspondence. Exiting the program."
-        print(msg)
-        log_msgs.append(msg)
+        _log("No filter correspondence. Exiting the program.")
         # This is the key argument for the assert pytest function
-        msg = "Test skipped because there is no flat correspondence for the filter in the data: {}".format(filt)
-        print(msg)
-        log_msgs.append(msg)
+        result_msg = f"Test skipped because there is no flat correspondence for the filter in the data: {filt}"
+        _log(result_msg)
         median_diff = "skip"
-        return median_diff, msg
+        return median_diff, result_msg, log_msgs
 
     if not os.path.isfile(sflat_path):
-        result_msg = "Test skipped because the S-flat provided does not exist: {}".format(sflat_path)
-        print(msg)
-        log_msgs.append(msg)
+        result_msg = f"Test skipped because the S-flat provided does not exist: {sflat_path}"
+        _log(result_msg)
         median_diff = "skip"
         return median_diff, result_msg, log_msgs
     sfile = sflat_path
-    msg = "    S-flat: " + sfile
-    print(msg)
-    log_msgs.append(msg)
+    _log(f"    S-flat: {sfile}")
     with fits.open(sfile) as sfile_hdu:
-        sfim = sfile_hdu["SCI"].data
-        sfimdq = sfile_hdu["DQ"].data
-        sfimerr = sfile_hdu["ERR"].data
+        sfim, sfimdq, sfimerr = auxfunc.read_image_extensions(sfile, ("SCI", "DQ", "ERR"), hdul=sfile_hdu)
         sffastvar = sfile_hdu["FAST_VARIATION"].data
 
     # F-Flat
     if not os.path.isfile(fflat_path):
-        result_msg = "Test skipped because the F-flat provided does not exist: {}".format(fflat_path)
-        print(msg)
-        log_msgs.append(msg)
+        result_msg = f"Test skipped because the F-flat provided does not exist: {fflat_path}"
+        _log(result_msg)
         median_diff = "skip"
         return median_diff, result_msg, log_msgs
     ffile = fflat_path
-    msg = "    F-flat: " + ffile
-    print(msg)
-    log_msgs.append(msg)
+    _log(f"    F-flat: {ffile}")
     with fits.open(ffile) as ffile_hdu:
         fffastvar = ffile_hdu["FAST_VARIATION"].data
         try:
-            fferr = ffile_hdu["ERR"].data
+            fferr = auxfunc.read_image_extensions(ffile, ("ERR",), hdul=ffile_hdu)[0]
         except KeyError:   # this version of the file did not have ERR extension
             fferr = np.zeros((2048, 2048))
 
@@ -320,20 +445,18 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
     pipeflat_dq = flatfile.dq
 
     # loop over the slices
-    all_delfg_mean, all_delfg_mean_arr, all_delfg_median, all_test_result = [], [], [], []
-    msg = " Now looping through the slices, this may take some time... "
-    print(msg)
-    log_msgs.append(msg)
+    all_delfg_mean, all_delfg_mean_arr, all_delfg_median = [], [], []
+    all_passed = True
+    _log(" Now looping through the slices, this may take some time... ")
     fullframe_calc_flat = np.full((2048, 2048), np.nan)
     fullframe_flat_err = np.full((2048, 2048), np.nan)
+    # integration lookup tables and integrals of the fast vectors, kept for all the slices
+    dfrqe_tab_cache, sfv_tab_cache, ffv_tab_cache = {}, {}, {}
+    # full frame pipeline-calculated difference image, allocated on first use and reused
+    diff_buf = None
     for n_ext, slice in enumerate(ifu_slits):
-        if n_ext < 10:
-            pslice = "0"+repr(n_ext)
-        else:
-            pslice = repr(n_ext)
-        msg = "Working with slice: "+pslice
-        print(msg)
-        log_msgs.append(msg)
+        pslice = f"{n_ext:02d}"
+        _log(f"Working with slice: {pslice}")
 
         # get the wavelength
         # slice.x(y)start are 1-based, turn them to 0-based for extraction
@@ -347,9 +470,7 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
         n_p = np.shape(wave)
         nx, ny = n_p[1], n_p[0]
         nw = nx * ny
-        msg = " Subwindow origin:   px0="+repr(px0)+"   py0="+repr(py0)
-        print(msg)
-        log_msgs.append(msg)
+        _log(f" Subwindow origin:   px0={px0!r}   py0={py0!r}")
 
         if debug:
             print("n_p = ", n_p)
@@ -360,157 +481,86 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
         flatcor = np.full(n_p, np.nan)
         flat_err = np.full(n_p, np.nan)
         delflaterr = np.full(n_p, np.nan)
-        calc_flat = np.full((2048, 2048), np.nan)
 
         # loop through the wavelengths
-        msg = " Looping through the wavelength, this may take a little time ... "
-        print(msg)
-        log_msgs.append(msg)
-        flat_wave = deepcopy(wave.flatten())
-        for j in range(0, nw):
-            if np.isfinite(flat_wave[j]):   # skip if wavelength is NaN
-                jwav = flat_wave[j]
-                if (jwav < 5.3) and (jwav >= 0.6):
-                    # get the pixel indices
-                    t = np.where(wave == jwav)
-                    pind = [t[0][0]+py0-1, t[1][0]+px0-1]   # pind =[pixel_y, pixe_x] in python, [x, y] in IDL
-                    #if debug:
-                    #    print('j, jwav, px0, py0 : ', j, jwav, px0, py0)
-                    #    print('pind[0], pind[1] = ', pind[0], pind[1])
-
-                    # get the pixel bandwidth **this needs to be modified for prism, since the dispersion is not linear!**
-                    delw = 0.1
-                    if (j != 0) and (int((j-1)/nx) == int(j/nx)) and (int((j+1)/nx) == int(j/nx)) and \
-                            np.isfinite(flat_wave[j+1]) and np.isfinite(flat_wave[j-1]):
-                        delw = 0.5 * (flat_wave[j+1] - flat_wave[j-1])
-                    if (j == 0) or not np.isfinite(flat_wave[j-1]) or (int((j-1)/nx) != int(j/nx)):
-                        delw = 0.5 * (flat_wave[j+1] - flat_wave[j])
-                    if (j == nw-1) or not np.isfinite(flat_wave[j+1]) or (int((j+1)/nx) != int(j/nx)):
-                        delw = 0.5 * (flat_wave[j] - flat_wave[j-1])
-
-                    # integrate over D-flat fast vector
-                    dfrqe_wav = dfrqe["wavelength"][0]
-                    dfrqe_rqe = dfrqe["data"][0]
-                    iw = np.where((dfrqe_wav >= jwav-delw/2.0) & (dfrqe_wav <= jwav+delw/2.0))
-                    if np.size(iw) > 2:
-                        int_tab = auxfunc.idl_tabulate(dfrqe_wav[iw], dfrqe_rqe[iw])
-                        first_dfrqe_wav, last_dfrqe_wav = dfrqe_wav[iw][0], dfrqe_wav[iw][-1]
-                        dff = int_tab/(last_dfrqe_wav - first_dfrqe_wav)
-                    else:
-                        dff = auxfunc.interp_close_pts(jwav, dfrqe_wav, dfrqe_rqe, debug)
-                    # the corresponding error is 0.0 because we currently have no information on this
-                    dff_err = 0.0
-
-                    # interpolate over D-flat cube and the corresponding error
-                    dfs, dfs_err = 1.0, 0.0
-                    if dfimdq[pind[0], pind[1]] == 0:
-                        dfs = np.interp(jwav, dfwave, dfim[:, pind[0], pind[1]])
-                        dfs_err = dfimerr[pind[0], pind[1]]
-
-                    # integrate over S-flat fast vector
-                    iw = np.where((sfv_wav >= jwav-delw/2.0) & (sfv_wav <= jwav+delw/2.0))
-                    if np.size(iw) > 2:
-                        int_tab = auxfunc.idl_tabulate(sfv_wav[iw], sfv_dat[iw])
-                        first_sfv_wav, last_sfv_wav = sfv_wav[iw][0], sfv_wav[iw][-1]
-                        sff = int_tab/(last_sfv_wav - first_sfv_wav)
-                    else:
-                        sff = auxfunc.interp_close_pts(jwav, sfv_wav, sfv_dat, debug)
-                    # the corresponding error is 0.0 because we currently have no information on this
-                    sff_err = 0.0
-
-                    # get s-flat pixel-dependent correction and the corresponding error
-                    sfs, sfs_err = 1.0, 0.0
-                    if sfimdq[pind[0], pind[1]] == 0:
-                        sfs = sfim[pind[0], pind[1]]
-                        sfs_err = sfimerr[pind[0], pind[1]]
-
-                    # No component of the f-flat slow component for IFU
-                    ffs, ffs_err = 1.0, 0.0
-
-                    # Integrate over f-flat fast vector
-                    iw = np.where((ffv_wav >= jwav-delw/2.0) & (ffv_wav <= jwav+delw/2.0))
-                    if np.size(iw) > 2:
-                        int_tab = auxfunc.idl_tabulate(ffv_wav[iw], ffv_dat[iw])
-                        first_ffv_wav, last_ffv_wav = ffv_wav[iw][0], ffv_wav[iw][-1]
-                        fff = int_tab/(last_ffv_wav - first_ffv_wav)
-                    else:
-                        fff = auxfunc.interp_close_pts(jwav, ffv_wav, ffv_dat, debug)
-
-                    # the corresponding error is 0.0 because we currently have no information on this
-                    # TODO: update when F-flat vectors have associated errors
-                    fff_err = 0.0
-
-                    flatcor.flat[j] = 1.0
-                    flatcor.flat[j] = dff * dfs * sff * sfs * fff * ffs
-                    # if there is a NaN (i.e. the pipeline is using this pixel but we are not), set this to 1.0
-                    # to match what the pipeline is doing. The value would be NaN if one or more of the 3 flat
-                    # components do not give a valid result because the wavelength is out of range. This is only
-                    # an issue for IFU since extract_2d is skipped.
-                    if np.isnan(flatcor.flat[j]) or flatcor.flat[j] <= 0.0 or pipeflat[pind[0], pind[1]] == 1:
-                        flatcor.flat[j] = 1.0
-
-                    # calculate the total error propagation
-                    try:
-                        dff_err2 = dff_err**2/dff**2
-                    except ZeroDivisionError:
-                        dff_err2 = 0.0
-                    try:
-                        dfs_err2 = dfs_err**2/dfs**2
-                    except ZeroDivisionError:
-                        dfs_err2 = 0.0
-                    try:
-                        sff_err2 = sff_err**2/sff**2
-                    except ZeroDivisionError:
-                        sff_err2 = 0.0
-                    try:
-                        sfs_err2 = sfs_err**2/sfs**2
-                    except ZeroDivisionError:
-                        sfs_err2 = 0.0
-                    try:
-                        fff_err2 = fff_err**2/fff**2
-                    except ZeroDivisionError:
-                        fff_err2 = 0.0
-                    try:
-                        ffs_err2 = ffs_err**2/ffs**2
-                    except ZeroDivisionError:
-                        ffs_err2 = 0.0
-                    if np.isnan(dff_err2):
-                        dff_err2 = 0.0
-                    if np.isnan(dfs_err2):
-                        dfs_err2 = 0.0
-                    if np.isnan(sff_err2):
-                        sff_err2 = 0.0
-                    if np.isnan(sfs_err2):
-                        sfs_err2 = 0.0
-                    if np.isnan(fff_err2):
-                        fff_err2 = 0.0
-                    if np.isnan(ffs_err2):
-                        ffs_err2 = 0.0
-                    error_sq_sum = dff_err2 + dfs_err2 + sff_err2 + sfs_err2 + fff_err2 + ffs_err2
-                    flat_err.flat[j] = np.sqrt(error_sq_sum) * flatcor.flat[j]
-
-                    # To visually compare between the pipeline flat and the calculated one (e.g. in ds9), Phil Hodge
-                    # suggested using the following line:
-                    calc_flat[pind[0], pind[1]] = flatcor.flat[j]
-
-                    # Write the calculated flat into the all slices-combined full frame array
-                    fullframe_calc_flat[pind[0], pind[1]] = flatcor.flat[j]
-                    fullframe_flat_err[pind[0], pind[1]] = flat_err.flat[j]
-
-                    # Difference between pipeline and calculated values
-                    delf.flat[j] = pipeflat[pind[0], pind[1]] - flatcor.flat[j]
-                    # difference between pipeline errors array and calculated values
-                    delflaterr.flat[j] = pipeflat_err[pind[0], pind[1]] - flat_err.flat[j]
-
-                    # Remove all pixels with values=1 or 0 (mainly inter-slit pixels),
-                    # or non-zero DQ for statistics
-                    if ((pipeflat[pind[0], pind[1]] == 1)
-                            or (pipeflat[pind[0], pind[1]] == 0)
-                            or (pipeflat_dq[pind[0], pind[1]] != 0)):
-                        delf.flat[j] = np.nan
-                        delflaterr.flat[j] = np.nan
-                        flatcor.flat[j] = np.nan
-                        flat_err.flat[j] = np.nan
+        _log(" Looping through the wavelength, this may take a little time ... ")
+        flat_wave = wave.ravel()
+        # only use the pixels with a wavelength in the range of the reference files
+        jidx = np.flatnonzero(np.isfinite(flat_wave) & (flat_wave < 5.3) & (flat_wave >= 0.6))
+        jwav = flat_wave[jidx]
+        # get the pixel indices, pind =[pixel_y, pixe_x] in python, [x, y] in IDL
+        pind = (jidx // nx + py0 - 1, jidx % nx + px0 - 1)
+
+        # get the pixel bandwidth **this needs to be modified for prism, since the dispersion is not linear!**
+        delw = get_pixel_bandwidth(flat_wave, nx)[jidx]
+        wav_lo, wav_hi = jwav - delw/2.0, jwav + delw/2.0
+
+        # integrate over D-flat fast vector
+        dff = get_fast_vector_values(jwav, wav_lo, wav_hi, dfrqe_wav, dfrqe_rqe, dfrqe_tab_cache, debug)
+        # the corresponding error is 0.0 because we currently have no information on this
+        dff_err = np.zeros(jwav.size)
+
+        # interpolate over D-flat cube and the corresponding error
+        dfs, dfs_err = np.ones(jwav.size), np.zeros(jwav.size, dtype=dfimerr.dtype)
+        good_dfs = dfimdq[pind] == 0
+        dfs[good_dfs] = interp_cube_spectra(jwav[good_dfs], dfwave, dfim[:, pind[0][good_dfs], pind[1][good_dfs]])
+        dfs_err[good_dfs] = dfimerr[pind][good_dfs]
+
+        # integrate over S-flat fast vector
+        sff = get_fast_vector_values(jwav, wav_lo, wav_hi, sfv_wav, sfv_dat, sfv_tab_cache, debug)
+        # the corresponding error is 0.0 because we currently have no information on this
+        sff_err = np.zeros(jwav.size)
+
+        # get s-flat pixel-dependent correction and the corresponding error
+        good_sfs = sfimdq[pind] == 0
+        sfs = np.where(good_sfs, sfim[pind], 1.0)
+        sfs_err = np.where(good_sfs, sfimerr[pind], 0.0)
+
+        # No component of the f-flat slow component for IFU
+        ffs, ffs_err = 1.0, 0.0
+
+        # Integrate over f-flat fast vector
+        fff = get_fast_vector_values(jwav, wav_lo, wav_hi, ffv_wav, ffv_dat, ffv_tab_cache, debug)
+        # the corresponding error is 0.0 because we currently have no information on this
+        # TODO: update when F-flat vectors have associated errors
+        fff_err = np.zeros(jwav.size)
+
+        flatcor_j = dff * dfs * sff * sfs * fff * ffs
+        # if there is a NaN (i.e. the pipeline is using this pixel but we are not), set this to 1.0
+        # to match what the pipeline is doing. The value would be NaN if one or more of the 3 flat
+        # components do not give a valid result because the wavelength is out of range. This is only
+        # an issue for IFU since extract_2d is skipped.
+        pipeflat_j = pipeflat[pind]
+        with np.errstate(invalid='ignore'):
+            flatcor_j[np.isnan(flatcor_j) | (flatcor_j <= 0.0) | (pipeflat_j == 1)] = 1.0
+
+        # calculate the total error propagation, the terms with no valid value do not contribute
+        error_sq_sum = np.zeros(jwav.size)
+        for fval, fval_err in ((dff, dff_err), (dfs, dfs_err), (sff, sff_err), (sfs, sfs_err),
+                               (fff, fff_err), (ffs, ffs_err)):
+            valid_term = (fval != 0.0) & np.isfinite(fval) & ~np.isnan(fval_err)
+            error_sq_sum += np.divide(np.square(fval_err), np.square(fval), out=np.zeros(jwav.size),
+                                      where=valid_term)
+        flat_err_j = np.sqrt(error_sq_sum) * flatcor_j
+
+        # Write the calculated flat into the all slices-combined full frame array
+        fullframe_calc_flat[pind] = flatcor_j
+        fullframe_flat_err[pind] = flat_err_j
+
+        # Difference between pipeline and calculated values
+        delf_j = pipeflat_j - flatcor_j
+        # difference between pipeline errors array and calculated values
+        delflaterr_j = pipeflat_err[pind] - flat_err_j
+
+        # Remove all pixels with values=1 or 0 (mainly inter-slit pixels),
+        # or non-zero DQ for statistics
+        no_stats = (pipeflat_j == 1) | (pipeflat_j == 0) | (pipeflat_dq[pind] != 0)
+        for pix_values in (delf_j, delflaterr_j, flatcor_j, flat_err_j):
+            pix_values[no_stats] = np.nan
+        delf.flat[jidx] = delf_j
+        delflaterr.flat[jidx] = delflaterr_j
+        flatcor.flat[jidx] = flatcor_j
+        flat_err.flat[jidx] = flat_err_j
 
         # attempt to remove outliers, for better statistics, only use points where pipe-calc <= 1.0
         outliers = (np.absolute(delf / flatcor) > 1.0)
@@ -524,9 +574,7 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
             delflaterr[outliers] = np.nan
 
         # calculate stats and print on screen
-        msg = "Flat value differences for slice number: "+pslice
-        print(msg)
-        log_msgs.append(msg)
+        _log(f"Flat value differences for slice number: {pslice}")
         stats_and_strings= auxfunc.print_stats(
             delf / flatcor, "Flat Difference", float(threshold_diff), absolute=False)
         stats, stats_print_strings = stats_and_strings
@@ -542,12 +590,10 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
         # make the slice plot
         if np.isfinite(delfg_median) and (len(delf)!=0):
             if show_figs or save_figs:
-                msg = "Making the plot for this slice..."
-                print(msg)
-                log_msgs.append(msg)
+                _log("Making the plot for this slice...")
                 # create histogram
-                pltnme = file_basename + "slice" + pslice + "_flatdiff_histogram.png"
-                title = filt+"   "+grat+"   SLICE="+pslice+"\n"
+                pltnme = f"{file_basename}slice{pslice}_flatdiff_histogram.png"
+                title = f"{filt}   {grat}   SLICE={pslice}\n"
                 plt_name = os.path.join(file_path, pltnme)
                 bins = None   # binning for the histograms, if None the function will select them automatically
                 title = title+"Residuals"
@@ -555,11 +601,16 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
                 xlabel, ylabel = "flat$_{pipe}$ - flat$_{calc}$", "N"
                 info_hist = [xlabel, ylabel, bins, stats]
                 if delf[1] is np.nan:
-                    msg = "Unable to create plot of relative wavelength difference."
-                    print(msg)
-                    log_msgs.append(msg)
+                    _log("Unable to create plot of relative wavelength difference.")
                 else:
-                    difference_img = pipeflat - calc_flat
+                    # To visually compare between the pipeline flat and the calculated one (e.g. in ds9), Phil
+                    # Hodge suggested using the calculated flat of this slice only; take it from the full frame
+                    # array, flatcor_j has the pixels excluded from the statistics set to NaN at this point
+                    if diff_buf is None:
+                        diff_buf = np.empty(pipeflat.shape, dtype=np.result_type(pipeflat, fullframe_calc_flat))
+                    diff_buf.fill(np.nan)
+                    diff_buf[pind] = pipeflat_j - fullframe_calc_flat[pind]
+                    difference_img = diff_buf
                     plt_origin = None
                     limits = [px0-2, px0+nx, py0-2, py0+ny]
                     # set the range of values to be shown in the image, will affect color scale
@@ -568,32 +619,18 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
                                                  show_figs=show_figs, save_figs=save_figs)
 
             elif not save_figs and not show_figs:
-                msg = "Not making plots because both show_figs and save_figs were set to False."
-                print(msg)
-                log_msgs.append(msg)
+                _log("Not making plots because both show_figs and save_figs were set to False.")
             elif not save_figs:
-                msg = "Not saving plots because save_figs was set to False."
-                print(msg)
-                log_msgs.append(msg)
+                _log("Not saving plots because save_figs was set to False.")
 
         # This is the key argument for the assert pytest function
-        median_diff = False
-        if abs(delfg_median) <= float(threshold_diff):
-            median_diff = True
-        if median_diff:
-            test_result = "PASSED"
-        else:
-            test_result = "FAILED"
-        msg = " *** Result of the test: "+test_result
-        print(msg)
-        log_msgs.append(msg)
-        all_test_result.append(test_result)
+        median_diff = bool(abs(delfg_median) <= float(threshold_diff))
+        _log(f" *** Result of the test: {'PASSED' if median_diff else 'FAILED'}")
+        all_passed &= median_diff
 
         # if the test is failed exit the script
         if not np.isfinite(delfg_median):
-            msg = "Unable to determine mean, median, and std_dev for the slice" + pslice
-            print(msg)
-            log_msgs.append(msg)
+            _log(f"Unable to determine mean, median, and std_dev for the slice{pslice}")
 
     if writefile:
         # this is the file to hold the image of pipeline-calculated difference values
@@ -604,20 +641,20 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
         outfile.append(outfile_ext)
 
         # this is the file to hold the image of pipeline-calculated difference values
-        difference_img = (pipeflat - fullframe_calc_flat)
+        if diff_buf is None:
+            diff_buf = np.empty(pipeflat.shape, dtype=np.result_type(pipeflat, fullframe_calc_flat))
+        difference_img = np.subtract(pipeflat, fullframe_calc_flat, out=diff_buf)
         complfile_ext = fits.ImageHDU(difference_img, name=pslice)
         complfile.append(complfile_ext)
 
         # the file is not yet written, indicate that this slit was appended to list to be written
-        msg = "Extension "+repr(n_ext)+" appended to list to be written into calculated and comparison fits files."
-        print(msg)
-        log_msgs.append(msg)
+        _log(f"Extension {n_ext!r} appended to list to be written into calculated and comparison fits files.")
 
     if mk_all_slices_plt:
         if show_figs or save_figs:
             # create histogram
-            pltnme = file_basename + "all_slices_IFU_flatdiff_histogram.png"
-            title = filt+"   "+grat+"   all slices\n"
+            pltnme = f"{file_basename}all_slices_IFU_flatdiff_histogram.png"
+            title = f"{filt}   {grat}   all slices\n"
             plot_name = os.path.join(file_path, pltnme)
             # calculate median of medians and std_dev of medians
             all_delfg_median_arr = np.array(all_delfg_median)
@@ -627,22 +664,19 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
             mk_hist(title, all_delfg_median_arr, mean_of_delfg_mean, median_of_delfg_median,
                     medians_std, save_figs, show_figs, plot_name=plot_name)
         elif not save_figs and not show_figs:
-            msg = "Not making plots because both show_figs and save_figs were set to False."
-            print(msg)
-            log_msgs.append(msg)
+            _log("Not making plots because both show_figs and save_figs were set to False.")
         elif not save_figs:
-            msg = "Not saving plots because save_figs was set to False."
-            print(msg)
-            log_msgs.append(msg)
+            _log("Not saving plots because save_figs was set to False.")
 
     # Total error calculation according to equation taken from:
     # https://jwst-pipeline.readthedocs.io/en/latest/jwst/flatfield/main.html
-    auxfunc.calc_flat_total_slt_err(flat_field_pipe_outfile, 'IFU',
-                                    flout_slt_sci, flout_slt_err,
-                                    input_sci, input_err, input_var_psn, input_var_rnse,
-                                    pipeflat.copy(), pipeflat_err.copy(),
-                                    fullframe_calc_flat.copy(), fullframe_flat_err.copy(),
-                                    show_plts=show_figs, save_plts=save_figs)
+    if calc_total_err:
+        auxfunc.calc_flat_total_slt_err(flat_field_pipe_outfile, 'IFU',
+                                        flout_slt_sci, flout_slt_err,
+                                        input_sci, input_err, input_var_psn, input_var_rnse,
+                                        pipeflat.copy(), pipeflat_err.copy(),
+                                        fullframe_calc_flat.copy(), fullframe_flat_err.copy(),
+                                        show_plts=show_figs, save_plts=save_figs)
 
     # close datamodels
     model.close()
@@ -655,52 +689,37 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, writefile=
         complfile_name = flat_field_pipe_outfile.replace("flat_field", "flat_comp")
 
         # create the fits list to hold the calculated flat values for each slit
-        outfile.writeto(outfile_name, overwrite=True)
+        outfile.writeto(outfile_name, overwrite=True, output_verify="ignore")
 
         # this is the file to hold the image of pipeline-calculated difference values
-        complfile.writeto(complfile_name, overwrite=True)
+        complfile.writeto(complfile_name, overwrite=True, output_verify="ignore")
 
-        msg = "Fits file with calculated flat values of each slice saved as: "
-        print(msg)
-        print(outfile_name)
-        log_msgs.append(msg)
-        log_msgs.append(outfile_name)
+        _log("Fits file with calculated flat values of each slice saved as: ")
+        _log(outfile_name)
 
-        msg = "Fits file with comparison (pipeline flat - calculated flat) saved as: "
-        print(msg)
-        print(complfile_name)
-        log_msgs.append(msg)
-        log_msgs.append(complfile_name)
+        _log("Fits file with comparison (pipeline flat - calculated flat) saved as: ")
+        _log(complfile_name)
 
     # If all tests passed then pytest will be marked as PASSED, else it will be FAILED
-    FINAL_TEST_RESULT = True
-    for t in all_test_result:
-        if t == "FAILED":
-            FINAL_TEST_RESULT = False
-            break
+    FINAL_TEST_RESULT = all_passed
     if FINAL_TEST_RESULT:
-        msg = " *** Final result for flat_field test will be reported as PASSED *** "
-        print(msg)
-        log_msgs.append(msg)
+        _log(" *** Final result for flat_field test will be reported as PASSED *** ")
         result_msg = "All slices PASSED flat_field test."
     else:
-        msg = " *** Final result for flat_field test will be reported as FAILED *** "
-        print(msg)
-        log_msgs.append(msg)
+        _log(" *** Final result for flat_field test will be reported as FAILED *** ")
         result_msg = "One or more slices FAILED flat_field test."
 
     # end the timer
     flattest_end_time = time.time() - flattest_start_time
     if flattest_end_time > 60.0:
         flattest_end_time = flattest_end_time/60.0  # in minutes
-        flattest_tot_time = "* Script flattest_ifu.py script took "+repr(flattest_end_time)+" minutes to finish."
+        flattest_tot_time = f"* Script flattest_ifu.py script took {flattest_end_time!r} minutes to finish."
         if flattest_end_time > 60.0:
             flattest_end_time = flattest_end_time/60.  # in hours
-            flattest_tot_time = "* Script flattest_ifu.py took "+repr(flattest_end_time)+" hours to finish."
+            flattest_tot_time = f"* Script flattest_ifu.py took {flattest_end_time!r} hours to finish."
     else:
-        flattest_tot_time = "* Script flattest_ifu.py took "+repr(flattest_end_time)+" seconds to finish."
-    print(flattest_tot_time)
-    log_msgs.append(flattest_tot_time)
+        flattest_tot_time = f"* Script flattest_ifu.py took {flattest_end_time!r} seconds to finish."
+    _log(flattest_tot_time)
 
     return FINAL_TEST_RESULT, result_msg, log_msgs
 
@@ -750,6 +769,11 @@ def main():
                         action='store_true',
                         default=False,
                         help='Use flag -d to turn on debug mode.')
+    parser.add_argument("-e",
+                        dest="calc_total_err",
+                        action='store_false',
+                        default=True,
+                        help='Use flag -e to NOT calculate and compare the total errors.')
     args = parser.parse_args()
 
     # Set variables
@@ -762,11 +786,12 @@ def main():
     show_figs = args.show_figs
     threshold_diff = args.threshold_diff
     debug = args.debug
+    calc_total_err = args.calc_total_err
 
     # Run the principal function of the script
     flattest(step_input_filename, dflat_path=dflat_path, sflat_path=sflat_path, fflat_path=fflat_path,
              writefile=writefile, mk_all_slices_plt=False, show_figs=show_figs, save_figs=save_figs,
-             plot_name=None, threshold_diff=threshold_diff, debug=debug)
+             threshold_diff=threshold_diff, debug=debug, calc_total_err=calc_total_err)
 
 
 if __name__ == '__main__':
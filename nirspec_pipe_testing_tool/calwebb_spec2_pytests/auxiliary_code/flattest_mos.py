@@ -174,16 +174,12 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, msa_shutte
     with fits.open(dfile) as dfhdu:
         dfhdr_sci = dfhdu["SCI"].header
         dfim = dfhdu["SCI"].data
-        dfimdq = dfhdu["DQ"].data
-        dfimerr = dfhdu["ERR"].data
         dfrqe = dfhdu["FAST_VARIATION"].data
+        dfimdq, dfimerr = auxfunc.read_image_extensions(dfile, ("DQ", "ERR"), hdul=dfhdu)
     ns = np.shape(dfim)
     naxis3 = dfhdr_sci["NAXIS3"]
     # get the wavelength values
-    dfwave = np.array([])
-    for i in range(naxis3):
-        keyword = "_".join(("PFLAT", str(i+1)))
-        dfwave = np.append(dfwave, dfhdr_sci[keyword])
+    dfwave = np.fromiter((dfhdr_sci["PFLAT_"+str(i+1)] for i in range(naxis3)), dtype=float, count=naxis3)
 
     # S-flat
     if filt == "F070LP":
@@ -218,9 +214,7 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, msa_shutte
     print(msg)
     log_msgs.append(msg)
     with fits.open(sfile) as sfhdu:
-        sfim = sfhdu["SCI"].data
-        sfimdq = sfhdu["DQ"].data
-        sfimerr = sfhdu["ERR"].data
+        sfim, sfimdq, sfimerr = auxfunc.read_image_extensions(sfile, ("SCI", "DQ", "ERR"), hdul=sfhdu)
         sffastvar = sfhdu["FAST_VARIATION"].data
         sfhdu_sci = sfhdu["SCI"].header
     sfv_wav, sfv_dat = auxfunc.get_slit_wavdat(sffastvar, 'ANY')
@@ -762,10 +756,10 @@ def flattest(step_input_filename, dflat_path, sflat_path, fflat_path, msa_shutte
         complfile_name = flat_field_pipe_outfile.replace("flat_field", "flat_comp")
 
         # this is the file to hold the image of pipeline-calculated difference values
-        outfile.writeto(outfile_name, overwrite=True)
+        outfile.writeto(outfile_name, overwrite=True, output_verify="ignore")
 
         # this is the file to hold the image of pipeline-calculated difference values
-        complfile.writeto(complfile_name, overwrite=True)
+        complfile.writeto(complfile_name, overwrite=True, output_verify="ignore")
 
         msg = "Fits file with calculated flat values of each slit saved as: "
         print(msg)
@@ -2,6 +2,8 @@
 py.test configuration for the *entire* test suite
 """
 
+import os
+import types
 import pytest
 import configparser
 
@@ -35,6 +37,41 @@ def config(request):
     return config
 
 
+@pytest.fixture(scope="session")
+def cfg_snapshot(config):
+    """
+    Values of the configuration file used by the step fixtures, read only once per session
+    """
+    initiate_calwebb_spc2 = "calwebb_spec2_input_file"
+    output_directory = config.get(initiate_calwebb_spc2, "output_directory")
+    initial_input_file = os.path.join(output_directory, config.get(initiate_calwebb_spc2, "input_file"))
+    return types.SimpleNamespace(
+        run_calwebb_spec2=config.get("run_calwebb_spec2_in_full", "run_calwebb_spec2"),
+        run_spec2_steps={stp: config.getboolean("run_spec2_steps", stp) for stp in config.options("run_spec2_steps")},
+        run_pytest={tst: config.getboolean("run_pytest", tst) for tst in config.options("run_pytest")},
+        change_filter_opaque=config.getboolean(initiate_calwebb_spc2, "change_filter_opaque"),
+        output_directory=output_directory,
+        initial_input_file=initial_input_file,
+        local_pipe_cfg_path=config.get(initiate_calwebb_spc2, "local_pipe_cfg_path"),
+    )
+
+
+@pytest.fixture(scope="session")
+def header_cache():
+    """
+    Headers already read during the session, keyed by (file, modification time, extension)
+    """
+    return {}
+
+
+@pytest.fixture(scope="session")
+def nptt_log_cache():
+    """
+    NPTT logger instances already set up during the session, keyed by log file path
+    """
+    return {}
+
+
 """
 @pytest.mark.hookwrapper
 def pytest_runtest_makereport(item, call):
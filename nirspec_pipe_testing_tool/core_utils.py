@@ -1,17 +1,37 @@
 import collections
+import contextlib
+import functools
+import hashlib
+import io
 import os
 import re
 import glob
 import time
 import subprocess
+import tempfile
 import configparser
 import logging
 from logging.handlers import RotatingFileHandler
+import pytest
 from astropy.io import fits
 from nirspec_pipe_testing_tool.calwebb_spec2_pytests import TESTSDIR
 
 import jwst
+from jwst import datamodels
 import nirspec_pipe_testing_tool as nptt
+from nirspec_pipe_testing_tool.utils import change_filter_opaque2science
+
+try:
+    import fitsio
+except ImportError:
+    # optional package, headers will be read with astropy
+    fitsio = None
+
+try:
+    from filelock import FileLock
+except ImportError:
+    # optional package, without it every process runs the pipeline step itself
+    FileLock = None
 
 '''
 This script contains functions frequently used in the test suite.
@@ -27,6 +47,9 @@ __version__ = "1.3"
 # Apr 2023 - Version 1.3: Cleaned-up code
 
 
+# time when the testing session started, step outputs written after it are from the current run
+session_start_time = time.time()
+
 # dictionary of the steps and corresponding strings to be added to the file name after the step has ran
 step_string_dict = collections.OrderedDict()
 # spec2
@@ -115,6 +138,144 @@ def mk_nptt_log(logname, reset=True):
     return logger
 
 
+@functools.lru_cache(maxsize=32)
+def isfile_cached(file_name):
+    """
+    This function checks if the file exists, remembering the answer for paths already checked. Call
+    isfile_cached.cache_clear() after writing new files, and before checking for files that other
+    processes may have written since.
+    Args:
+        file_name: string, path of the file
+
+    Returns:
+        boolean, True if the file exists
+    """
+    return os.path.isfile(file_name)
+
+
+def step_output_lock(step_output_file):
+    """
+    This function provides a lock on the step output file so that only one process at a time runs the
+    pipeline step that produces it, e.g. when running with pytest-xdist. The lock file is kept in the
+    temporary directory, so that nothing is left behind in the output directory.
+    Args:
+        step_output_file: string, path of the step output file
+
+    Returns:
+        lock: context manager, does nothing if the filelock package is not installed
+    """
+    if FileLock is None:
+        return contextlib.nullcontext()
+    output_path_hash = hashlib.md5(os.path.abspath(step_output_file).encode()).hexdigest()
+    lock_file = "nptt_" + os.path.basename(step_output_file) + "_" + output_path_hash + ".lock"
+    return FileLock(os.path.join(tempfile.gettempdir(), lock_file))
+
+
+def is_fresh_output(step_output_file, step_input_file):
+    """
+    This function checks if the step output file was already written during the current testing
+    session from the current input file.
+    Args:
+        step_output_file: string, path of the step output file
+        step_input_file: string, path of the step input file
+
+    Returns:
+        boolean, True if the output file does not need to be produced again
+    """
+    try:
+        output_mtime = os.stat(step_output_file).st_mtime
+    except FileNotFoundError:
+        return False
+    return output_mtime >= max(session_start_time, os.stat(step_input_file).st_mtime)
+
+
+def save_step_result(result, step_output_file):
+    """
+    This function saves the pipeline step result. Single data models are serialized in memory and then
+    written to disk in one go, which is much faster on high latency file systems; containers of models
+    are saved with their own save method since they write one file per model.
+    Args:
+        result: data model or model container returned by the pipeline step
+        step_output_file: string, path of the output fits file
+
+    Returns:
+        nothing
+    """
+    if isinstance(result, datamodels.ModelContainer) or not step_output_file.endswith(".fits"):
+        result.save(step_output_file)
+        return
+    # keep the file name keyword as the model save method would have set it
+    result.meta.filename = os.path.basename(step_output_file)
+    buffer = io.BytesIO()
+    result.to_fits(buffer, overwrite=True)
+    with open(step_output_file, "wb") as output_file:
+        output_file.write(buffer.getbuffer())
+
+
+def read_headers(fits_file_name, exts, fast=False):
+    """
+    This function reads the headers of the given extensions opening the file only once. The HDUs are
+    loaded lazily and no data is read or scaled.
+    Args:
+        fits_file_name: string, name of the fits file of interest
+        exts: list, extension numbers or names
+        fast: boolean, if True and fitsio is installed the headers are read with fitsio and returned
+              as dictionaries, only use when the headers are just queried for keywords
+
+    Returns:
+        headers: list, astropy header objects (or dictionaries) in the same order as exts
+    """
+    if fast and fitsio is not None:
+        headers = []
+        with fitsio.FITS(fits_file_name) as ff:
+            for ext in exts:
+                hdr = ff[ext].read_header()
+                headers.append({keywd: hdr[keywd] for keywd in hdr.keys()})
+        return headers
+    with fits.open(fits_file_name, lazy_load_hdus=True, memmap=False, do_not_scale_image_data=True) as hdul:
+        headers = [hdul[ext].header.copy() for ext in exts]
+    return headers
+
+
+def cached_getheaders(fits_file_name, exts, cache=None, fast=False):
+    """
+    This function reads the headers of the given extensions, re-using the headers already read if the file
+    has not been modified since. Headers not yet in the cache are read in a single file open.
+    Args:
+        fits_file_name: string, name of the fits file of interest
+        exts: list, extension numbers or names
+        cache: dictionary, headers already read, if None the headers are read from disk
+        fast: boolean, if True the headers may be read with fitsio (see read_headers)
+
+    Returns:
+        headers: list, astropy header objects (or dictionaries) in the same order as exts
+    """
+    if cache is None:
+        return read_headers(fits_file_name, exts, fast=fast)
+    mtime = os.path.getmtime(fits_file_name)
+    missing = [ext for ext in exts if (fits_file_name, mtime, ext, fast) not in cache]
+    if missing:
+        for ext, header in zip(missing, read_headers(fits_file_name, missing, fast=fast)):
+            cache[(fits_file_name, mtime, ext, fast)] = header
+    return [cache[(fits_file_name, mtime, ext, fast)] for ext in exts]
+
+
+def cached_getheader(fits_file_name, ext=0, cache=None, fast=False):
+    """
+    This function reads the header of the given extension, re-using the header already read if the file
+    has not been modified since.
+    Args:
+        fits_file_name: string, name of the fits file of interest
+        ext: integer or string, extension number or name
+        cache: dictionary, headers already read, if None the header is read from disk
+        fast: boolean, if True the header may be read with fitsio (see read_headers)
+
+    Returns:
+        header: astropy header object (or dictionary)
+    """
+    return cached_getheaders(fits_file_name, [ext], cache=cache, fast=fast)[0]
+
+
 def get_sci_extensions(fits_file_name):
     """
     This function obtains all the science extensions in the given file
@@ -150,7 +311,7 @@ def get_step_inandout_filename(step, initial_input_file, output_directory, debug
     """
 
     # make sure the input file name has the detector included in the name of the output files
-    hdr = fits.getheader(initial_input_file)
+    hdr = fits.getheader(initial_input_file, memmap=False)
     detector = hdr["DETECTOR"]
     exp_type = hdr["EXP_TYPE"]
     initial_input_file_basename = os.path.basename(initial_input_file)
@@ -476,6 +637,23 @@ def add_completed_steps(True_steps_suffix_map, step, outstep_file_suffix, step_c
         nothing
     """
     # print ("Map saved at: ", True_steps_suffix_map)
+    line2write = get_completed_step_line(step, outstep_file_suffix, step_completed, end_time)
+    with open(True_steps_suffix_map, "a") as tf:
+        tf.write(line2write + "\n")
+
+
+def get_completed_step_line(step, outstep_file_suffix, step_completed, end_time):
+    """
+    This function formats the line of the completed steps text file for the given step.
+    Args:
+        step: string, pipeline step just ran
+        outstep_file_suffix: string, suffix added right before .fits to the input file
+        step_completed: boolean, True if the step was completed and False if it was skipped
+        end_time: string, time it took for the step to run (in seconds)
+
+    Returns:
+        line2write: string
+    """
     if (float(end_time)) > 60.0:
         end_time_min = float(end_time) / 60.  # this is in minutes
         if end_time_min > 60.0:
@@ -484,8 +662,27 @@ def add_completed_steps(True_steps_suffix_map, step, outstep_file_suffix, step_c
         else:
             end_time = repr(end_time) + "  =" + repr(round(end_time_min, 1)) + "min"
     line2write = "{:<20} {:<20} {:<20} {:<20}".format(step, outstep_file_suffix, str(step_completed), end_time)
-    with open(True_steps_suffix_map, "a") as tf:
-        tf.write(line2write + "\n")
+    return line2write
+
+
+def write_completed_steps(completed_steps):
+    """
+    This function writes the completed steps collected during a test module into their text files, with
+    one open per file.
+    Args:
+        completed_steps: list, tuples of the arguments of add_completed_steps
+
+    Returns:
+        nothing
+    """
+    lines_per_map = collections.OrderedDict()
+    for True_steps_suffix_map, step, outstep_file_suffix, step_completed, end_time in completed_steps:
+        line2write = get_completed_step_line(step, outstep_file_suffix, step_completed, end_time)
+        lines_per_map.setdefault(True_steps_suffix_map, []).append(line2write + "\n")
+    for True_steps_suffix_map, lines in lines_per_map.items():
+        with open(True_steps_suffix_map, "a") as tf:
+            tf.writelines(lines)
+    del completed_steps[:]
 
 
 def start_end_nptt_time(txt_name, start_time=None, end_time=None):
@@ -637,6 +834,167 @@ def read_info4output_vars(config, step_info):
     return set_inandout_filenames_info
 
 
+def build_output_vars(step_class, set_inandout_filenames, config, cfg_snapshot, header_cache, nptt_log_cache,
+                      test_types=("completion",), ifu_step=False, needs_sci_header=False,
+                      get_output_suffix=None, completed_steps=None):
+    """
+    This function contains the work shared by the output_vars fixtures of the calwebb_spec2 step modules: it
+    determines if the step applies to the data, runs the pipeline step if requested, records it in the
+    completed steps map, and reads the output headers.
+    Args:
+        step_class: pipeline step class, e.g. WavecorrStep
+        set_inandout_filenames: list, output of the set_inandout_filenames fixture
+        config: object, this is the configuration file object
+        cfg_snapshot: namespace, configuration values read once per session
+        header_cache: dictionary, session cache of headers already read
+        nptt_log_cache: dictionary, session cache of the NPTT logger instances
+        test_types: tuple, types of pytest of the step, e.g. ("completion", "reffile")
+        ifu_step: boolean, if True the step only runs for IFU data, else it only runs for non-IFU data
+        needs_sci_header: boolean, if True the SCI header of the output file is also returned
+        get_output_suffix: function, takes the output file name and input header and returns the suffix to
+                           record in the map after running the step; if None, the step output suffix is used
+        completed_steps: list, if given, the entries for the completed steps map are appended to it for
+                         write_completed_steps instead of being written right away
+
+    Returns:
+        output_vars: tuple, (outhdr, step_output_file, run_pytests, nptt_log), with the SCI header before the
+                     logger instance if needs_sci_header is True
+    """
+    # determine if the pipeline is to be run in full, per steps, or skipped
+    run_calwebb_spec2 = cfg_snapshot.run_calwebb_spec2
+    if run_calwebb_spec2 == "skip":
+        print('\n * NPTT finished processing run_calwebb_spec2 is set to skip. \n')
+        pytest.exit("Skipping pipeline run and tests for spec2, run_calwebb_spec2 is set to skip in NPTT_config file.")
+    run_calwebb_spec2 = "T" in run_calwebb_spec2
+
+    # files may have been written by other processes or by previous steps since the last check
+    isfile_cached.cache_clear()
+
+    # get the general info
+    set_inandout_filenames_info = read_info4output_vars(config, set_inandout_filenames)
+    step, txt_name, step_input_file, step_output_file, outstep_file_suffix = set_inandout_filenames_info
+    run_pipe_step = cfg_snapshot.run_spec2_steps[step]
+
+    # determine which tests are to be run
+    run_pytests = [cfg_snapshot.run_pytest["_".join((step, test_type, "tests"))] for test_type in test_types]
+
+    def add_completed_step(outstep_file_suffix, step_completed, end_time):
+        if completed_steps is None:
+            add_completed_steps(txt_name, step, outstep_file_suffix, step_completed, end_time)
+        else:
+            completed_steps.append((txt_name, step, outstep_file_suffix, step_completed, end_time))
+
+    # if run_calwebb_spec2 is True calwebb_spec2 will be called, else individual steps will be ran
+    step_completed = False
+    end_time = '0.0'
+
+    # only run the step for the type of data it applies to
+    output_directory = cfg_snapshot.output_directory
+    if isfile_cached(cfg_snapshot.initial_input_file):
+        inhdr = cached_getheader(step_input_file, cache=header_cache, fast=True)
+    else:
+        pytest.skip("Skipping "+step+" because the initial input file given in NPTT_config.cfg does not exist.")
+    if check_IFU_true(inhdr) != ifu_step:
+        if ifu_step:
+            pytest.skip("Skipping "+step+" because data is not IFU.")
+        add_completed_step(outstep_file_suffix, step_completed, end_time)
+        pytest.skip("Skipping "+step+" because data is IFU.")
+    detector = inhdr["DETECTOR"]
+
+    # check if the filter is to be changed
+    change_filter_opaque = cfg_snapshot.change_filter_opaque
+    if change_filter_opaque:
+        is_filter_opaque, step_input_filename = change_filter_opaque2science.change_filter_opaque(step_input_file,
+                                                                                                  step=step)
+        if is_filter_opaque:
+            filter_opaque_msg = "With FILTER=OPAQUE, the calwebb_spec2 will run up to the extract_2d step. " \
+                                + step + " pytest now set to Skip."
+            print(filter_opaque_msg)
+            add_completed_step(outstep_file_suffix, step_completed, end_time)
+            pytest.skip("Skipping "+step+" because FILTER=OPAQUE.")
+
+    # with the full pipeline already run there is nothing left to do if no tests are enabled
+    if run_calwebb_spec2 and not any(run_pytests):
+        pytest.skip("No enabled pytest flags for " + step)
+
+    # Get the logfile instance for NPTT created in the run.py script
+    nptt_log_path = os.path.join(output_directory, 'NPTT_calspec2_' + detector + '.log')
+    if nptt_log_path not in nptt_log_cache:
+        nptt_log_cache[nptt_log_path] = mk_nptt_log(nptt_log_path, reset=False)
+    nptt_log = nptt_log_cache[nptt_log_path]
+
+    if not run_calwebb_spec2:
+        if run_pipe_step:
+            if not isfile_cached(step_input_file):
+                msg = " The input file does not exist. Skipping step."
+                print(msg)
+                nptt_log.info(msg)
+                add_completed_step(outstep_file_suffix, step_completed, end_time)
+                pytest.skip("Skipping "+step+" because the input file does not exist.")
+
+            # Create the pipeline step log
+            stp_pipelog = "calspec2_" + step + "_" + detector + ".log"
+            mk_stpipe_log_cfg(output_directory, stp_pipelog)
+            print("Pipeline step screen output will be logged in file: ", stp_pipelog)
+
+            msg = " *** Step "+step+" set to True"
+            print(msg)
+            nptt_log.info(msg)
+
+            # check that previous pipeline steps were run up to this point
+            check_completed_steps(step, step_input_file)
+
+            # get the right configuration files to run the step
+            local_pipe_cfg_path = cfg_snapshot.local_pipe_cfg_path
+            step_produced = False
+            with step_output_lock(step_output_file):
+                # another process may have already run the step on this input
+                if not is_fresh_output(step_output_file, step_input_file):
+                    # start the timer to compute the step running time
+                    start_time = time.time()
+                    if local_pipe_cfg_path == "pipe_source_tree_code":
+                        result = step_class.call(step_input_file)
+                    else:
+                        result = step_class.call(step_input_file, config_file=local_pipe_cfg_path+'/'+step+'.cfg')
+                    save_step_result(result, step_output_file)
+                    # end the timer to compute the step running time
+                    end_time = f"{time.time() - start_time:.6f}"   # this is in seconds
+                    step_produced = True
+            isfile_cached.cache_clear()
+            if step_produced:
+                msg = "Step "+step+" took "+end_time+" seconds to finish"
+                if get_output_suffix is not None:
+                    outstep_file_suffix = get_output_suffix(step_output_file, inhdr)
+            else:
+                msg = "Step "+step+" output was already produced by another process, using file: "+step_output_file
+            print(msg)
+            nptt_log.info(msg)
+
+        else:
+            msg = "Skipping running pipeline step "+step
+            print(msg)
+            nptt_log.info(msg)
+            end_time = get_stp_run_time_from_screenfile(step, detector, output_directory)
+            if not isfile_cached(step_output_file):
+                # add the running time for this step
+                add_completed_step(outstep_file_suffix, step_completed, end_time)
+                pytest.skip("Test skipped because input file "+step_output_file+" does not exist.")
+
+        # add the running time for this step, the process that produced the output already did
+        step_completed = True
+        if not run_pipe_step or step_produced:
+            add_completed_step(outstep_file_suffix, step_completed, end_time)
+
+    # read the output headers
+    if needs_sci_header:
+        outhdr, scihdr = cached_getheaders(step_output_file, [0, 'SCI'], cache=header_cache)
+        output_vars = outhdr, step_output_file, run_pytests, scihdr, nptt_log
+    else:
+        outhdr = cached_getheader(step_output_file, cache=header_cache)
+        output_vars = outhdr, step_output_file, run_pytests, nptt_log
+    return output_vars
+
+
 def check_FS_true(hdr):
     """
     This function checks if the fits file is a Fixed Slit.
@@ -713,7 +1071,7 @@ def check_completed_steps(step, step_input_file, caldet1=False):
         nothing but prints warnings
     """
     # get the header of the file
-    hdr = fits.getheader(step_input_file)
+    hdr = fits.getheader(step_input_file, memmap=False)
 
     # get all the completed steps
     steps_caldet1 = ["GRPSCL", "DQINIT", "SATURA", "SUPERB", "REFPIX", "LINEAR", "DARK", "JUMP", "RAMP", "GANSCL"]
@@ -522,7 +522,7 @@ def run_nptt(report_name=None, config_path=None, uncal_file=None, verbose=False)
         print("\n Running Spec2 tests... ")
         report_name = report_name.replace(".html", "_spec2.html")
         args = ['pytest', '-s', '--config_file='+config_path, '--html='+report_name,
-                '--self-contained-html', calwebb_spec2_pytests.TESTSDIR]
+                '--self-contained-html', '-p', 'no:cacheprovider', calwebb_spec2_pytests.TESTSDIR]
         if not verbose:
             args.pop(1)
         subprocess.run(args)
@@ -540,7 +540,7 @@ def run_nptt(report_name=None, config_path=None, uncal_file=None, verbose=False)
             report_name = report_name.replace("_spec2", "")
         report_name = report_name.replace(".html", "_spec3.html")
         args = ['pytest', '-s', '--config_file='+config_path, '--html='+report_name,
-                '--self-contained-html', calwebb_spec3_pytests.TESTSDIR]
+                '--self-contained-html', '-p', 'no:cacheprovider', calwebb_spec3_pytests.TESTSDIR]
         if not verbose:
             args.pop(1)
         subprocess.run(args)